@@ -1,141 +1,421 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import atexit
+import gc
+import gzip
+import hashlib
+import math
+import tempfile
 import time
+import io
 import json
+import ijson
+import orjson
+import re2
+import numpy as np
 import pandas as pd
-from datetime import datetime
-import matplotlib.pyplot as plt
+import polars as pl
+import pyarrow as pa
+from datetime import datetime, timezone
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import os
 
+# urllib3 can only decode brotli responses when the brotli package is installed
+try:
+    import brotli  # noqa: F401
+    _ACCEPT_ENCODING = "gzip, br"
+except ImportError:
+    _ACCEPT_ENCODING = "gzip"
+
+# Shared session so repeated requests reuse the keep-alive connection to the API
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504],
+                      raise_on_status=False)
+)
+_SESSION.mount("https://", _ADAPTER)
+_SESSION.mount("http://", _ADAPTER)
+_SESSION.headers.update({"Accept-Encoding": _ACCEPT_ENCODING, "Connection": "keep-alive"})
+atexit.register(_SESSION.close)
+
+# Known layout of an inflow record, used to build typed columns directly
+SCHEMA = pa.schema([
+    ('start_time', pa.int64()),
+    ('inflow_mean', pa.float64()),
+    ('inflow_mean_ma7', pa.float64()),
+    ('inflow_top10', pa.float64()),
+    ('inflow_total', pa.float64())
+])
+KNOWN_COLS = tuple(SCHEMA.names)
+
+# re2 matches in linear time, so a string full of unmatched braces cannot trigger backtracking
+_OBJ_RE = re2.compile(rb'\{[^{}]*\}')
+
+# Raw API responses are cached on disk, keyed on the request parameters
+CACHE_DIR = os.path.join(".cache", "cryptoquant")
+RECENT_CACHE_TTL = 24 * 3600
+
+# Response dicts handed out by fetch_cryptoquant_data, by cache path, so the parsed frame
+# cache is only used for the exact payload that was stored at that path
+_CACHED_RESPONSES = {}
+
+def _cache_path(params):
+    key = hashlib.md5(json.dumps(params, sort_keys=True).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.json.gz")
+
+def _read_cache(path, ttl):
+    if not (os.path.exists(path) and time.time() - os.path.getmtime(path) < ttl):
+        return None
+    
+    try:
+        with gzip.open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    except (EOFError, OSError, gzip.BadGzipFile, orjson.JSONDecodeError):
+        # A damaged entry is a miss, drop it so the range gets fetched again
+        print(f"Discarding unreadable cache entry {path}")
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+def _replace_atomically(path, write):
+    # Write to a temp file in the cache dir and swap it into place, so an interrupted
+    # write or a concurrent run never leaves a truncated entry behind
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _write_cache(path, data):
+
+    def write(tmp_path):
+        with gzip.open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(data))
+
+    _replace_atomically(path, write)
+
+def clear_cache():
+    if not os.path.exists(CACHE_DIR):
+        return 0
+    
+    names = os.listdir(CACHE_DIR)
+    for name in names:
+        os.remove(os.path.join(CACHE_DIR, name))
+    _CACHED_RESPONSES.clear()
+    removed = sum(name.endswith('.json.gz') for name in names)
+    frames = sum(name.endswith('.parquet') for name in names)
+    print(f"Removed {removed} cached responses and {frames} parsed frames from {CACHE_DIR}")
+    return removed
+
+def cache_stats():
+    if not os.path.exists(CACHE_DIR):
+        return {'entries': 0, 'frames': 0, 'size_bytes': 0}
+    
+    names = os.listdir(CACHE_DIR)
+    return {
+        'entries': sum(name.endswith('.json.gz') for name in names),
+        'frames': sum(name.endswith('.parquet') for name in names),
+        'size_bytes': sum(os.path.getsize(os.path.join(CACHE_DIR, name)) for name in names)
+    }
+
+def _utc_date(d):
+    # Pin dates to UTC, time.mktime used the local timezone and shifted the window by the UTC offset
+    return datetime.strptime(d, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+
+def _to_ms(dt):
+    return int(dt.timestamp() * 1000)
+
+def response_cache_path(exchange, window, start_date, end_date):
+    return _cache_path({
+        "exchange": exchange,
+        "window": window,
+        "start_time": _to_ms(_utc_date(start_date)),
+        "end_time": _to_ms(_utc_date(end_date))
+    })
+
+def _date_chunks(start, end, months=1):
+    # Split [start, end] into calendar-month windows, yielded as (start_ms, end_ms) pairs
+    chunk_start = start
+    while chunk_start < end:
+        month_index = chunk_start.month - 1 + months
+        next_start = chunk_start.replace(year=chunk_start.year + month_index // 12, month=month_index % 12 + 1,
+                                         day=1, hour=0, minute=0, second=0, microsecond=0)
+        if next_start < end:
+            # Stop 1ms short of the next window so boundary records are not fetched twice
+            yield _to_ms(chunk_start), _to_ms(next_start) - 1
+        else:
+            yield _to_ms(chunk_start), _to_ms(end)
+        chunk_start = next_start
+
+def _fetch_chunk(url, params):
+
+    # Stream the body so it is decompressed straight into orjson without building response.content
+    response = _SESSION.get(url, params=params, timeout=(5, 30), stream=True)
+    if response.status_code == 429:
+        # Still rate limited after the adapter retries, wait as instructed and try once more
+        response.close()
+        try:
+            retry_after = float(response.headers.get("Retry-After", 1))
+        except ValueError:
+            retry_after = 1
+        time.sleep(retry_after)
+        response = _SESSION.get(url, params=params, timeout=(5, 30), stream=True)
+    with response:
+        response.raise_for_status()  # Raise an exception for HTTP errors
+        body = orjson.loads(response.raw.read(decode_content=True))
+    
+    # An error or quota body can come back with a 200, fail the whole fetch rather than lose the month
+    if not isinstance(body, dict) or not isinstance(body.get('data'), list):
+        raise ValueError(f"Unexpected response for {params['start_time']}-{params['end_time']}: {str(body)[:200]}")
+    return body['data']
+
 def fetch_cryptoquant_data(api_key, exchange="okx", window="hour", start_date="2020-04-01", end_date="2024-01-01"):
 
-    start_timestamp = int(time.mktime(datetime.strptime(start_date, "%Y-%m-%d").timetuple()) * 1000)
-    end_timestamp = int(time.mktime(datetime.strptime(end_date, "%Y-%m-%d").timetuple()) * 1000)
+    start_dt = _utc_date(start_date)
+    end_dt = _utc_date(end_date)
     
     url = "https://api.datasource.cybotrade.rs/cryptoquant/btc/exchange-flows/inflow"
     
     params = {
         "exchange": exchange,
-        "window": window,
-        "start_time": start_timestamp,
-        "end_time": end_timestamp
+        "window": window
     }
     
-    headers = {"X-API-Key": api_key}
+    end_timestamp = _to_ms(end_dt)
+    cache_path = response_cache_path(exchange, window, start_date, end_date)
+    
+    # Inflow for ranges that ended over a week ago no longer changes, so keep it forever
+    if end_timestamp < (time.time() - 7 * 86400) * 1000:
+        ttl = math.inf
+    else:
+        ttl = RECENT_CACHE_TTL
+    
+    cached = _read_cache(cache_path, ttl)
+    if cached is not None:
+        print(f"Loaded {len(cached.get('data', []))} records for {exchange} from cache")
+        _CACHED_RESPONSES[cache_path] = cached
+        return cached
+    
+    _SESSION.headers["X-API-Key"] = api_key
     
     print(f"Fetching data for {exchange} from {start_date} to {end_date}...")
     
     try:
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()  # Raise an exception for HTTP errors
+        # Fetch one month per request in parallel, all sharing the pooled session
+        merged = []
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            futures = [
+                pool.submit(_fetch_chunk, url, {**params, "start_time": s, "end_time": e})
+                for s, e in _date_chunks(start_dt, end_dt)
+            ]
+            for future in as_completed(futures):
+                merged.extend(future.result())
         
-        # Process the response
-        if response.status_code == 200:
-            data = response.json()
-            print(f"Successfully received data with {len(data.get('data', []))} records")
-            return data
-        else:
-            print(f"Error: {response.status_code} - {response.text}")
-            return None
+        # Chunks complete out of order
+        merged.sort(key=lambda item: item.get('start_time', 0))
+        data = {"data": merged}
+        print(f"Successfully received data with {len(merged)} records")
+        # An empty result usually means a bad exchange name or window, so never pin it in the cache
+        if merged:
+            _write_cache(cache_path, data)
+            _CACHED_RESPONSES[cache_path] = data
+        return data
     except Exception as e:
         print(f"Exception occurred: {str(e)}")
         return None
 
-def parse_cryptoquant_data(data_input):
+def _parse_slow(data_input):
 
-    if data_input is None:
-        print("No data to parse")
-        return pd.DataFrame()
+    if isinstance(data_input, str):
+
+        # Stream the records out of the raw response text with ijson's C backend,
+        # accepting either a complete response or a bare array of records
+        raw = data_input.encode()
+        try:
+            data_items = list(ijson.items(io.BytesIO(raw), 'data.item', use_float=True))
+            if not data_items:
+                data_items = list(ijson.items(io.BytesIO(raw), 'item', use_float=True))
+        except ijson.JSONError:
+            data_items = []
+        
+        if not data_items:
+            # Malformed or unexpected text, salvage whatever flat records can still be found
+            # and skip metadata or error objects that are not inflow records
+            print("Could not find records in data string, scanning it for individual records")
+            skipped = 0
+            for match in _OBJ_RE.finditer(raw):
+                try:
+                    record = orjson.loads(match.group())
+                except orjson.JSONDecodeError:
+                    # orjson rejects the NaN/Infinity tokens json.dumps writes, the stdlib parser accepts them
+                    try:
+                        record = json.loads(match.group())
+                    except json.JSONDecodeError:
+                        skipped += 1
+                        continue
+                if 'start_time' in record:
+                    data_items.append(record)
+            if skipped:
+                print(f"Skipped {skipped} objects that could not be decoded")
+        print(f"Extracted {len(data_items)} data items from string")
+        return data_items
+    
+    if not isinstance(data_input, list):
+        # e.g. an error body such as {"error": "invalid key"} with no data field
+        print(f"Error: cannot parse {type(data_input).__name__} input: {str(data_input)[:200]}")
+        return []
     
+    print(f"Processing {len(data_input)} data items from list")
+    return data_input
+
+def _read_frame(frame_path, cache_path):
+    if not (os.path.exists(frame_path) and os.path.exists(cache_path)
+            and os.path.getmtime(frame_path) >= os.path.getmtime(cache_path)):
+        return None
+    
+    try:
+        return pd.read_parquet(frame_path)
+    except (OSError, ValueError):
+        # A damaged frame is a miss, drop it so it gets rebuilt from the response
+        print(f"Discarding unreadable cached frame {frame_path}")
+        try:
+            os.remove(frame_path)
+        except OSError:
+            pass
+        return None
+
+def parse_cryptoquant_data(data_input, cache_path=None):
+
+    # The parsed frame is kept next to the cached response it came from and reused
+    # for as long as that response has not been refetched
+    frame_path = None
+    if cache_path and data_input is not None and _CACHED_RESPONSES.get(cache_path) is data_input:
+        frame_path = cache_path.replace('.json.gz', '.parquet')
+        df = _read_frame(frame_path, cache_path)
+        if df is not None:
+            print(f"Loaded DataFrame with {len(df)} rows and {len(df.columns)} columns from cache")
+            return df
+    
+    # A complete API response is the common case and already holds the flat record list
     if isinstance(data_input, dict) and 'data' in data_input:
         data_items = data_input['data']
         print(f"Parsing {len(data_items)} data items from complete response")
+    elif data_input is None:
+        print("No data to parse")
+        return pd.DataFrame()
     else:
-
-        if isinstance(data_input, str):
-
-            import re
-            pattern = r'\{[^{}]*\}'
-            matches = re.findall(pattern, data_input)
-            data_items = []
-            for match in matches:
-                try:
-                    data_items.append(json.loads(match))
-                except json.JSONDecodeError:
-                    continue
-            print(f"Extracted {len(data_items)} data items from string")
-        else:
-
-            data_items = data_input
-            print(f"Processing {len(data_items)} data items from list")
+        data_items = _parse_slow(data_input)
     
     if not data_items:
         print("No data items were found")
         return pd.DataFrame()
     
-    # Create DataFrame
-    df = pd.DataFrame(data_items)
-    
-    if 'start_time' in df.columns:
-        df['start_time'] = pd.to_datetime(df['start_time'], unit='ms')
+    # Create DataFrame straight from typed Arrow buffers instead of inferring each column,
+    # every KNOWN_COLS column is present afterwards (null where a record lacks it)
+    df = pa.Table.from_pylist(data_items, schema=SCHEMA).to_pandas()
     
-    # Make sure datetime column is properly formatted
-    if 'datetime' not in df.columns and 'start_time' in df.columns:
-        # Format the start_time as a datetime string
-        df['datetime'] = df['start_time'].dt.strftime('%Y-%m-%d %H:%M:%S')
+    # start_time is epoch milliseconds, so reinterpret the int64 buffer as datetime64[ms] without parsing,
+    # records without one get int64 min, which is exactly the NaT bit pattern
+    df['start_time'] = df['start_time'].to_numpy(dtype='int64', na_value=np.iinfo('int64').min).view('datetime64[ms]')
+    df['datetime'] = df['start_time']
     
-    numeric_columns = ['inflow_mean', 'inflow_mean_ma7', 'inflow_top10', 'inflow_total']
-    for col in numeric_columns:
-        if col in df.columns:
-            df[col] = df[col].round(4)
+    numeric_columns = list(KNOWN_COLS[1:])
+    # Round all numeric columns in one numpy call rather than one Series op per column
+    df[numeric_columns] = np.round(df[numeric_columns].to_numpy(dtype='float64'), 4)
     
     # Reorder columns for better readability
-    ordered_columns = ['datetime', 'start_time']
-    for col in numeric_columns:
-        if col in df.columns:
-            ordered_columns.append(col)
-    
-    available_columns = [col for col in ordered_columns if col in df.columns]
-    df = df[available_columns]
+    df = df[['datetime', *KNOWN_COLS]]
     
     print(f"Created DataFrame with {len(df)} rows and {len(df.columns)} columns")
+    
+    if frame_path and os.path.exists(cache_path):
+        _replace_atomically(frame_path, lambda tmp_path: df.to_parquet(tmp_path, engine='pyarrow', index=False))
     return df
 
+# Polars equivalents of the statistics produced by pandas' describe()
+DESCRIBE_STATS = {
+    'count': lambda col: col.count(),
+    'mean': lambda col: col.mean(),
+    'std': lambda col: col.std(),
+    'min': lambda col: col.min(),
+    '25%': lambda col: col.quantile(0.25, interpolation='linear'),
+    '50%': lambda col: col.median(),
+    '75%': lambda col: col.quantile(0.75, interpolation='linear'),
+    'max': lambda col: col.max()
+}
+
+def _format_time(value):
+    # polars returns missing timestamps as None, report them the way pandas printed NaT
+    return 'NaT' if value is None else str(value)
+
 def analyze_btc_inflow(df):
 
     if df.empty:
         return {"error": "No data available for analysis"}
     
-    if 'datetime' in df.columns and not pd.api.types.is_datetime64_any_dtype(df['datetime']):
-        df['datetime'] = pd.to_datetime(df['datetime'])
+    numeric_columns = ['inflow_mean', 'inflow_mean_ma7', 'inflow_top10', 'inflow_total']
+    present_columns = [col for col in numeric_columns if col in df.columns]
+    
+    # Build every aggregation as one lazy query so polars computes them in a single scan
+    lf = pl.from_pandas(df).lazy()
+    stats_exprs = [
+        pl.col('datetime').min().alias('start'),
+        pl.col('datetime').max().alias('end')
+    ]
+    for col in present_columns:
+        values = pl.col(col).cast(pl.Float64)
+        stats_exprs.extend(stat(values).alias(f"{col}|{name}") for name, stat in DESCRIBE_STATS.items())
+    queries = [lf.select(stats_exprs)]
+    
+    # Find top inflow events, a stable sort keeps the earliest of tied rows first like nlargest
+    if 'inflow_total' in df.columns:
+        queries.append(
+            lf.filter(pl.col('inflow_total').is_not_null())
+            .sort('inflow_total', descending=True, maintain_order=True)
+            .head(5)
+            .select(['datetime', 'inflow_total'])
+        )
+    
+    collected = pl.collect_all(queries)
+    stats = collected[0].row(0, named=True)
     
     results = {
         'total_records': len(df),
         'date_range': {
-            'start': str(df['datetime'].min()),
-            'end': str(df['datetime'].max())
+            'start': _format_time(stats['start']),
+            'end': _format_time(stats['end'])
         },
         'summary_stats': {}
     }
     
-
-    numeric_columns = ['inflow_mean', 'inflow_mean_ma7', 'inflow_top10', 'inflow_total']
-    for col in numeric_columns:
-        if col in df.columns:
-
-            stats_dict = df[col].describe().to_dict()
-
-            results['summary_stats'][col] = {k: float(v) for k, v in stats_dict.items()}
+    for col in present_columns:
+        results['summary_stats'][col] = {
+            name: math.nan if stats[f"{col}|{name}"] is None else float(stats[f"{col}|{name}"])
+            for name in DESCRIBE_STATS
+        }
     
-    # Find top inflow events
     if 'inflow_total' in df.columns:
-        top_events = df.nlargest(5, 'inflow_total')
-        results['top_inflow_events'] = []
-        for _, row in top_events.iterrows():
-            event = {
-                'datetime': str(row['datetime']),
-                'inflow_total': float(row['inflow_total'])
-            }
-            results['top_inflow_events'].append(event)
+        # Pull the two columns out whole and zip them instead of materialising each row
+        top_events = collected[1]
+        event_times = [_format_time(event_time) for event_time in top_events['datetime'].to_list()]
+        inflow_totals = top_events['inflow_total'].cast(pl.Float64).to_list()
+        results['top_inflow_events'] = [
+            {'datetime': event_time, 'inflow_total': inflow_total}
+            for event_time, inflow_total in zip(event_times, inflow_totals)
+        ]
     
     return results
 
@@ -153,35 +433,44 @@ def visualize_data(df, output_dir="output"):
     elif 'start_time' in df.columns:
         df['datetime'] = df['start_time']
     
-    df_plot = df.set_index('datetime')
+    # Plotting only needs screen precision, so draw from a float32 copy and keep df in float64
+    plot_columns = [col for col in ['inflow_mean', 'inflow_mean_ma7', 'inflow_top10', 'inflow_total'] if col in df.columns]
+    df_plot = df.set_index('datetime')[plot_columns].astype('float32')
+    
+    # One Agg figure is reused for every chart so nothing is left registered with pyplot
+    fig = Figure(figsize=(12, 6))
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
     
     if 'inflow_total' in df.columns:
-        plt.figure(figsize=(12, 6))
-        df_plot['inflow_total'].plot(title='Bitcoin Total Inflow Over Time')
-        plt.ylabel('Total Inflow (BTC)')
-        plt.grid(True)
-        plt.tight_layout()
-        plt.savefig(os.path.join(output_dir, 'total_inflow_over_time.png'))
-        plt.close()
+        ax.clear()
+        df_plot['inflow_total'].plot(ax=ax, title='Bitcoin Total Inflow Over Time')
+        ax.set_ylabel('Total Inflow (BTC)')
+        ax.grid(True)
+        fig.tight_layout()
+        fig.savefig(os.path.join(output_dir, 'total_inflow_over_time.png'))
         
         if 'inflow_mean_ma7' in df.columns:
-            plt.figure(figsize=(12, 6))
-            df_plot['inflow_mean_ma7'].plot(title='Bitcoin Inflow 7-Day Moving Average')
-            plt.ylabel('7-Day MA Inflow (BTC)')
-            plt.grid(True)
-            plt.tight_layout()
-            plt.savefig(os.path.join(output_dir, 'inflow_7day_ma.png'))
-            plt.close()
+            ax.clear()
+            df_plot['inflow_mean_ma7'].plot(ax=ax, title='Bitcoin Inflow 7-Day Moving Average')
+            ax.set_ylabel('7-Day MA Inflow (BTC)')
+            ax.grid(True)
+            fig.tight_layout()
+            fig.savefig(os.path.join(output_dir, 'inflow_7day_ma.png'))
         
         if 'inflow_mean' in df.columns and 'inflow_top10' in df.columns:
-            plt.figure(figsize=(12, 6))
-            df_plot[['inflow_mean', 'inflow_top10']].plot(title='Mean vs Top 10 Inflow Comparison')
-            plt.ylabel('Inflow (BTC)')
-            plt.grid(True)
-            plt.legend(['Mean Inflow', 'Top 10 Inflow'])
-            plt.tight_layout()
-            plt.savefig(os.path.join(output_dir, 'mean_vs_top10_inflow.png'))
-            plt.close()
+            ax.clear()
+            df_plot[['inflow_mean', 'inflow_top10']].plot(ax=ax, title='Mean vs Top 10 Inflow Comparison')
+            ax.set_ylabel('Inflow (BTC)')
+            ax.grid(True)
+            ax.legend(['Mean Inflow', 'Top 10 Inflow'])
+            fig.tight_layout()
+            fig.savefig(os.path.join(output_dir, 'mean_vs_top10_inflow.png'))
+    
+    # Drop the artists and collect now so repeated runs do not hold on to canvas buffers until gc
+    fig.clear()
+    del fig, ax
+    gc.collect()
     
     print(f"Visualizations saved to {output_dir}")
 
@@ -198,12 +487,12 @@ def main():
     data = fetch_cryptoquant_data(api_key, exchange, "hour", start_date, end_date)
     
     # Parse data
-    df = parse_cryptoquant_data(data)
+    df = parse_cryptoquant_data(data, response_cache_path(exchange, "hour", start_date, end_date))
     
     if not df.empty:
-        # Save raw data to CSV
-        output_file = f"btc_{exchange}_inflow_{start_date}_to_{end_date}.csv"
-        df.to_csv(output_file, index=False)
+        # Save raw data to Parquet
+        output_file = f"btc_{exchange}_inflow_{start_date}_to_{end_date}.parquet"
+        df.to_parquet(output_file, engine='pyarrow', compression='zstd', compression_level=3, index=False)
         print(f"Data saved to {output_file}")
         
         # Analyze data
@@ -211,8 +500,8 @@ def main():
         
         # Save analysis to JSON
         analysis_file = f"btc_{exchange}_analysis_{start_date}_to_{end_date}.json"
-        with open(analysis_file, 'w') as f:
-            json.dump(analysis, f, indent=2)
+        with open(analysis_file, 'wb') as f:
+            f.write(orjson.dumps(analysis, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
         print(f"Analysis saved to {analysis_file}")
         
         visualize_data(df)